@@ -1,55 +1,65 @@
 import os
 from langgraph.graph import StateGraph, START, END
-from langgraph.types import Send
 from langgraph.checkpoint.memory import MemorySaver
 
 from state import DocumentState
 from nodes import (
-    planner_node, 
-    writer_node, 
+    plan_and_dispatch_node, 
     aggregator_node, 
+    cache_doc_node, 
+    index_doc_node, 
     wait_for_query_node, 
-    thinker_node, 
-    answer_node
+    qa_node
 )
 
-def assign_workers(state: DocumentState):
-    """Conditional edge: fan-out to writers."""
-    return [
-        Send("writer", {"section_topic": s, "index": i}) 
-        for i, s in enumerate(state["sections_to_write"])
-    ]
-
 def skip_if_exists(state: DocumentState):
     """Check if the document already exists to skip generation."""
     if os.path.exists(state["file_path"]):
-        return "wait_for_query"
-    return "planner"
-
-# Initialize Graph
-builder = StateGraph(DocumentState)
-
-# Add Nodes
-builder.add_node("planner", planner_node)
-builder.add_node("writer", writer_node)
-builder.add_node("aggregator", aggregator_node)
-builder.add_node("wait_for_query", wait_for_query_node)
-builder.add_node("thinker", thinker_node)
-builder.add_node("answer", answer_node)
-
-# Define Flow
-builder.add_conditional_edges(
+        return END
+    return "plan_and_dispatch"
+
+def index_if_uncached(state: DocumentState):
+    """Only build the retrieval index when the document could not be cached."""
+    if state.get("cache_name"):
+        return "qa"
+    return "index_doc"
+
+# Generation Graph: plan -> write -> aggregate
+gen_builder = StateGraph(DocumentState)
+
+gen_builder.add_node("plan_and_dispatch", plan_and_dispatch_node)
+gen_builder.add_node("aggregator", aggregator_node)
+
+gen_builder.add_conditional_edges(
     START, 
     skip_if_exists,
-    {"planner": "planner", "wait_for_query": "wait_for_query"}
+    {"plan_and_dispatch": "plan_and_dispatch", END: END}
+)
+gen_builder.add_edge("plan_and_dispatch", "aggregator")
+gen_builder.add_edge("aggregator", END)
+
+# Runs straight through, so no checkpointer: avoids snapshotting state after every step
+gen_graph = gen_builder.compile()
+
+# QA Graph: interrupt for a query -> cache (or index) document -> think & answer
+# Caching happens after the query arrives so the cache TTL does not run out while waiting on the user
+qa_builder = StateGraph(DocumentState)
+
+qa_builder.add_node("cache_doc", cache_doc_node)
+qa_builder.add_node("index_doc", index_doc_node)
+qa_builder.add_node("wait_for_query", wait_for_query_node)
+qa_builder.add_node("qa", qa_node)
+
+qa_builder.add_edge(START, "wait_for_query")
+qa_builder.add_edge("wait_for_query", "cache_doc")
+qa_builder.add_conditional_edges(
+    "cache_doc", 
+    index_if_uncached,
+    {"index_doc": "index_doc", "qa": "qa"}
 )
-builder.add_conditional_edges("planner", assign_workers, ["writer"])
-builder.add_edge("writer", "aggregator")
-builder.add_edge("aggregator", "wait_for_query")
-builder.add_edge("wait_for_query", "thinker")
-builder.add_edge("thinker", "answer")
-builder.add_edge("answer", END)
+qa_builder.add_edge("index_doc", "qa")
+qa_builder.add_edge("qa", END)
 
 # Checkpointer for interrupt support
 memory = MemorySaver()
-graph = builder.compile(checkpointer=memory)
+qa_graph = qa_builder.compile(checkpointer=memory)
@@ -1,22 +1,159 @@
+import asyncio
+import functools
+import logging
 import os
+from typing import Dict, Optional
+import aiohttp
 from dotenv import load_dotenv
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
 
 load_dotenv()
 
-# Check for API key early
-if not os.getenv("GOOGLE_API_KEY"):
-    raise EnvironmentError("GOOGLE_API_KEY must be set in your environment or .env file.")
-
-# Orchestrator & Thinker: Requires high reasoning capacity
-pro_llm = ChatGoogleGenerativeAI(
-    model="gemini-3-pro-preview",
-    temperature=1.0,  # CRITICAL for Gemini 3.0 models as per plan
-    max_retries=2
-)
-
-# Workers & Synthesizer: Faster, high-volume generation
-flash_llm = ChatGoogleGenerativeAI(
-    model="gemini-3-flash-preview",
-    temperature=1.0  # CRITICAL for Gemini 3.0 models as per plan
-)
+def _require_api_key():
+    """Fails fast with a clear message; deferred to first use so importing the graph needs no key."""
+    if not os.getenv("GOOGLE_API_KEY"):
+        raise EnvironmentError("GOOGLE_API_KEY must be set in your environment or .env file.")
+
+# One keep-alive HTTP session per event loop, shared by every model so concurrent
+# calls reuse warm TLS connections instead of each client opening its own pool.
+# A plain dict: the session holds its loop strongly, so weak keys would never be
+# evicted anyway; close_pooled_session removes the entry
+_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+def _pooled_session() -> aiohttp.ClientSession:
+    """Returns the shared session for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            # Sized from the writer window (plus the planner stream running alongside it)
+            # so the pool never becomes a tighter cap than WRITER_CONCURRENCY
+            connector=aiohttp.TCPConnector(limit=writer_concurrency + 1, keepalive_timeout=60),
+            # Mirror the SDK's own session: honour HTTP(S)_PROXY and allow 4 MB stream lines
+            trust_env=True,
+            read_bufsize=2**22
+        )
+        _sessions[loop] = session
+    return session
+
+async def close_pooled_session():
+    """Closes the shared session for the running event loop; call before the loop shuts down."""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+class PooledChatGoogleGenerativeAI(ChatGoogleGenerativeAI):
+    """ChatGoogleGenerativeAI whose async calls go through the shared per-loop session."""
+
+    def _use_pooled_session(self):
+        api_client = self.client._api_client
+        session = _pooled_session()
+        # Registering it as a caller-provided client stops the SDK from closing it
+        api_client._http_options.aiohttp_client = session
+        api_client._aiohttp_session = session
+
+    async def _agenerate(self, *args, **kwargs):
+        self._use_pooled_session()
+        return await super()._agenerate(*args, **kwargs)
+
+    async def _astream(self, *args, **kwargs):
+        self._use_pooled_session()
+        async for chunk in super()._astream(*args, **kwargs):
+            yield chunk
+
+# Clients are built on first call and cached, so importing this module (e.g. to
+# draw the graph) neither constructs them nor requires an API key
+
+@functools.lru_cache(maxsize=None)
+def pro_llm() -> PooledChatGoogleGenerativeAI:
+    """Orchestrator & Thinker: Requires high reasoning capacity"""
+    _require_api_key()
+    return PooledChatGoogleGenerativeAI(
+        model="gemini-3-pro-preview",
+        temperature=1.0,  # CRITICAL for Gemini 3.0 models as per plan
+        max_retries=2
+    )
+
+@functools.lru_cache(maxsize=None)
+def flash_llm() -> PooledChatGoogleGenerativeAI:
+    """Workers & Synthesizer: Faster, high-volume generation"""
+    _require_api_key()
+    return PooledChatGoogleGenerativeAI(
+        model="gemini-3-flash-preview",
+        temperature=1.0,  # CRITICAL for Gemini 3.0 models as per plan
+        # No SDK-level retries: 429s must surface to rate_limited so it can shrink the window;
+        # rate_limited also retries the transient 408/5xx errors the SDK would have retried
+        max_retries=1
+    )
+
+@functools.lru_cache(maxsize=None)
+def embedder() -> GoogleGenerativeAIEmbeddings:
+    """Retriever: Section and query embeddings for QA when the document is not cached"""
+    _require_api_key()
+    return GoogleGenerativeAIEmbeddings(
+        model="gemini-embedding-001",
+        output_dimensionality=768  # Keeps the per-section vectors in state small
+    )
+
+logger = logging.getLogger(__name__)
+
+def extract_text(response) -> str:
+    """Extract only the text content, handling potential list of content blocks."""
+    content = response.content
+    # Gemini returns a plain string by default; exact type checks skip the isinstance MRO walk
+    if type(content) is str:
+        return content
+    if type(content) is list:
+        return "".join(block.get("text", "") if type(block) is dict else str(block) for block in content)
+    return str(content)
+
+# Concurrency window for writer calls: keeps in-flight requests within the
+# provider's rate-limit budget instead of bursting into 429 retries.
+writer_concurrency = int(os.getenv("WRITER_CONCURRENCY", "12"))
+WRITER_SEM = asyncio.Semaphore(writer_concurrency)
+RATE_LIMIT_RETRIES = 3
+rate_limit_hits = 0
+# Same transient statuses the SDK retries by default, minus 429 which is handled separately
+TRANSIENT_STATUS_CODES = {408, 500, 502, 503, 504}
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    """HTTP status of the error (or the SDK error it wraps), if any."""
+    while exc is not None:
+        code = getattr(exc, "code", None)
+        if isinstance(code, int):
+            return code
+        exc = exc.__cause__
+    return None
+
+async def rate_limited(call):
+    """Awaits `call()` under WRITER_SEM, shrinking the window whenever a 429 is seen.
+
+    `call` is re-run from scratch on a 429 or a transient 408/5xx error, so it must
+    be safe to repeat. Transient errors back off without shrinking the window.
+    """
+    global writer_concurrency, rate_limit_hits
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        await WRITER_SEM.acquire()
+        retire_permit = False
+        try:
+            return await call()
+        except Exception as exc:
+            code = _status_code(exc)
+            if (code != 429 and code not in TRANSIENT_STATUS_CODES) or attempt == RATE_LIMIT_RETRIES:
+                raise
+            if code == 429:
+                rate_limit_hits += 1
+                # Keep this permit out of circulation to lower the concurrency window
+                if writer_concurrency > 1:
+                    writer_concurrency -= 1
+                    retire_permit = True
+                logger.warning(
+                    "Rate limited (429 #%d); writer concurrency now %d.",
+                    rate_limit_hits, writer_concurrency
+                )
+            else:
+                logger.warning("Transient error (%d); retrying writer call.", code)
+        finally:
+            if not retire_permit:
+                WRITER_SEM.release()
+        await asyncio.sleep(2 ** attempt)
@@ -1,8 +1,18 @@
+import asyncio
 import os
 from langgraph.types import Command
-from graph import graph
+from graph import gen_graph, qa_graph
+from llm import close_pooled_session
 
-def run_legal_app():
+# uvloop is an optional, faster drop-in event loop; fall back to the stdlib loop
+# where it is unavailable (e.g. Windows or free-threaded builds).
+try:
+    import uvloop
+    run_async = uvloop.run
+except ImportError:
+    run_async = asyncio.run
+
+async def _run_legal_app():
     # 1. Configuration
     thread_id = "legal_doc_001"
     config = {"configurable": {"thread_id": thread_id}}
@@ -13,7 +23,6 @@ def run_legal_app():
         "contract_topic": "Enterprise SaaS Master Service Agreement",
         "file_path": file_path,
         "completed_sections": 0,
-        "generated_sections": [],
         "sections_to_write": []
     }
     
@@ -23,22 +32,22 @@ def run_legal_app():
     else:
         print("--- Starting Document Generation ---")
     
-    # Run until interrupt
-    try:
-        state = graph.get_state(config)
-        if state.next:
-            print("Resuming from previous pause...")
-        else:
-            # This will either run the whole generation OR skip to interrupt
-            graph.invoke(initial_state, config)
-    except Exception as e:
-        # Expected interrupt or error
-        pass
-
-    # Re-fetch state to check for interrupt
-    state = graph.get_state(config)
+    # Generation runs to completion without checkpoints (skips if the file exists);
+    # only the file on disk carries over to the QA graph
+    await gen_graph.ainvoke(initial_state)
     
-    if state.next and "wait_for_query" in state.next:
+    # Run QA until interrupt. One state read decides between starting and resuming;
+    # a fresh run reports its pause in the returned "__interrupt__" key, so real
+    # errors propagate instead of being swallowed
+    state = await qa_graph.aget_state(config)
+    if state.next:
+        print("Resuming from previous pause...")
+        paused = "wait_for_query" in state.next
+    else:
+        result = await qa_graph.ainvoke({"contract_topic": initial_state["contract_topic"], "file_path": file_path}, config)
+        paused = "__interrupt__" in result
+    
+    if paused:
         if not os.path.exists(file_path):
              print("\nWarning: Document generation interrupted or failed to save.")
         
@@ -47,7 +56,7 @@ def run_legal_app():
         
         print("\n--- Starting CoT Analysis ---")
         # Resume the graph with the user's query
-        final_state = graph.invoke(
+        final_state = await qa_graph.ainvoke(
             Command(resume=user_query),
             config
         )
@@ -58,7 +67,14 @@ def run_legal_app():
         print("\n--- Final Answer ---")
         print(final_state.get("final_answer"))
     else:
-        print(f"Graph execution finished or reached unexpected state. Next nodes: {state.next}")
+        print("Graph execution finished or reached unexpected state without pausing for a query.")
+
+async def run_legal_app():
+    try:
+        await _run_legal_app()
+    finally:
+        # Release the shared HTTP session while its event loop is still running
+        await close_pooled_session()
 
 if __name__ == "__main__":
-    run_legal_app()
+    run_async(run_legal_app())
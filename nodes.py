@@ -1,115 +1,384 @@
+import asyncio
+import glob
+import hashlib
+import json
+import math
 import os
-from typing import List
+import re
+from typing import List, Optional, Tuple
+import aiofiles
+from google.genai.errors import APIError
+from langchain_core.messages import HumanMessage
+from langchain_google_genai import create_context_cache
+from langchain_google_genai.chat_models import ChatGoogleGenerativeAIError
 from langgraph.types import interrupt
-from state import DocumentState, WorkerState, SectionOutline, SectionResult
-from llm import pro_llm, flash_llm
+from state import DocumentState, QAResponse, SectionIndexEntry
+from llm import pro_llm, flash_llm, embedder, rate_limited, extract_text
 
-def planner_node(state: DocumentState):
-    """Generates a structured outline of section titles."""
-    topic = state["contract_topic"]
-    # Using structured output for precision
-    structured_llm = pro_llm.with_structured_output(SectionOutline)
-    prompt = f"Create a detailed outline for a 50-page legal document on the topic: {topic}. Output ~50 section titles."
-    outline: SectionOutline = structured_llm.invoke(prompt)
-    return {"sections_to_write": outline.sections}
-
-def writer_node(state: WorkerState):
-    """Generates the content for a single section."""
-    topic = state["section_topic"]
-    index = state["index"]
-    prompt = f"""Write a comprehensive, professional legal text for the section: '{topic}'. 
-
-STRICT REQUIREMENTS:
-1. Output ONLY the legal text for this section.
+WRITER_BATCH_SIZE = int(os.getenv("WRITER_BATCH_SIZE", "8"))
+
+SECTION_OPEN_TAG = re.compile(r"<SEC (\d+)>")
+SECTION_FILE = re.compile(r"_sec_(\d+)\.md$")
+OUTLINE_MARKER = re.compile(r"^\s*(?:[-*#]+|\d+(?:\.\d+)+\.?|\d+[.)])\s+")
+
+DOC_CACHE_TTL = os.getenv("DOC_CACHE_TTL", "1800s")
+RETRIEVAL_TOP_K = 5
+
+WRITER_REQUIREMENTS = """STRICT REQUIREMENTS:
+1. Output ONLY the legal text for each section.
 2. DO NOT include any preamble, intro, or "Here is the text".
 3. DO NOT include any signatures, footer notes, metadata, or JSON-like structures.
 4. Output raw text only, no markdown code blocks wrapping the content.
 5. Be dense and detailed in formal legalese.
 """
-    response = flash_llm.invoke(prompt)
-    
-    # Extract only the text content, handling potential list of content blocks
-    content = response.content
-    if isinstance(content, list):
-        content = "".join([block.get("text", "") if isinstance(block, dict) else str(block) for block in content])
-    elif not isinstance(content, str):
-        content = str(content)
-        
-    # Return the section result to be aggregated later
-    return {
-        "generated_sections": [{
-            "title": topic,
-            "content": content,
-            "index": index
-        }],
-        "completed_sections": 1
-    }
 
-def aggregator_node(state: DocumentState):
-    """Collects all generated sections, sorts them, and writes to disk."""
-    # Sort by original index to ensure document order
-    sorted_sections = sorted(state["generated_sections"], key=lambda x: x["index"])
-    
+def _section_path(file_path: str, index: int) -> str:
+    """Temp file holding one finished section, named so a filename sort restores document order."""
+    return os.path.join(os.path.dirname(file_path), f"_sec_{index:03d}.md")
+
+def _section_parts(file_path: str) -> List[str]:
+    """All section temp files next to the output file, in document order."""
+    parts = {}
+    for path in glob.glob(os.path.join(os.path.dirname(file_path), "_sec_*.md")):
+        if match := SECTION_FILE.search(path):
+            parts[int(match.group(1))] = path
+    # Keyed by numeric index, so order holds even past the zero-padding width
+    return [path for _, path in sorted(parts.items())]
+
+def _writer_context(topic: str) -> str:
+    """Shared prompt prefix, byte-identical across every writer call so the provider can reuse its prompt cache."""
+    return f"""Document topic: {topic}.
+
+{WRITER_REQUIREMENTS}"""
+
+class _SectionBody:
+    """Writes a streamed section body with surrounding whitespace trimmed, so every section is spaced alike."""
+
+    def __init__(self, f):
+        self.f = f
+        self.at_start = True
+        self.pending = ""  # Trailing whitespace, written only if more text follows it
+
+    async def write(self, text: str):
+        if self.at_start:
+            text = text.lstrip()
+            self.at_start = not text
+        text = self.pending + text
+        body = text.rstrip()
+        self.pending = text[len(body):]
+        if body:
+            await self.f.write(body)
+
+    async def finish(self):
+        # Trailing whitespace is dropped so the section ends in exactly one blank line
+        await self.f.write("\n\n")
+
+async def _write_section(file_path: str, context: str, topic: str, index: int):
+    """Streams a single section straight into its file (fallback for unparsed batch entries)."""
+    prompt = f"""{context}
+Section index {index}.
+Write a comprehensive, professional legal text for the section: '{topic}'.
+"""
+
+    async def stream():
+        # Reopened with "w", so a rate-limit retry simply starts the file over
+        async with aiofiles.open(_section_path(file_path, index), "w") as f:
+            await f.write(f"## {topic}\n\n")
+            body = _SectionBody(f)
+            async for chunk in flash_llm().astream(prompt):
+                await body.write(extract_text(chunk))
+            await body.finish()
+
+    await rate_limited(stream)
+
+async def _stream_batch(file_path: str, prompt: str, titles: dict) -> set:
+    """Streams a batched response, routing each <SEC i> body into section i's file as tokens arrive.
+
+    Returns the indices whose closing tag was seen; anything else needs a retry.
+    """
+    written = set()
+    buffer = ""
+    index, f, body = None, None, None  # Section currently being streamed, its open file and body writer
+    try:
+        async for chunk in flash_llm().astream(prompt):
+            buffer += extract_text(chunk)
+            while True:
+                if index is None:
+                    match = SECTION_OPEN_TAG.search(buffer)
+                    if match is None:
+                        # Keep a tail in case an opening tag is split across chunks
+                        buffer = buffer[-16:]
+                        break
+                    index, buffer = int(match.group(1)), buffer[match.end():]
+                    # Unknown or repeated sections are parsed but discarded
+                    if index in titles and index not in written:
+                        f = await aiofiles.open(_section_path(file_path, index), "w")
+                        await f.write(f"## {titles[index]}\n\n")
+                        body = _SectionBody(f)
+                    continue
+
+                close_tag = f"</SEC {index}>"
+                end = buffer.find(close_tag)
+                # Hold back anything that could be the start of a split closing tag
+                text = buffer[:end] if end != -1 else buffer[:max(len(buffer) - len(close_tag) + 1, 0)]
+                buffer = buffer[len(text):]
+                if body is not None:
+                    await body.write(text)
+                if end == -1:
+                    break
+
+                buffer = buffer[len(close_tag):]
+                if f is not None:
+                    await body.finish()
+                    await f.close()
+                    written.add(index)
+                index, f, body = None, None, None
+    finally:
+        if f is not None:
+            await f.close()
+    return written
+
+async def _write_batch(file_path: str, context: str, chunk: List[str], start_index: int) -> int:
+    """Generates the content for a chunk of sections in a single streamed LLM call, writing each to disk."""
+    indices = range(start_index, start_index + len(chunk))
+
+    titles = "\n".join(f"Write section <<{i}>>: {topic}" for i, topic in zip(indices, chunk))
+    prompt = f"""{context}
+Section index {start_index} to {start_index + len(chunk) - 1}.
+Write comprehensive, professional legal text for each of the following sections.
+
+{titles}
+
+Return each body wrapped in <SEC i>...</SEC i> tags, where i is the section number above.
+"""
+    section_titles = dict(zip(indices, chunk))
+    written = await rate_limited(lambda: _stream_batch(file_path, prompt, section_titles))
+
+    # Sections the model dropped, mis-tagged or cut off are regenerated individually, in parallel
+    await asyncio.gather(*(
+        _write_section(file_path, context, topic, i)
+        for i, topic in section_titles.items() if i not in written
+    ))
+    return len(chunk)
+
+def _parse_title(line: str) -> Optional[str]:
+    """Returns the title from one JSON Lines record, or None for anything else the model emits."""
+    try:
+        # Records copied out of a JSON array keep their separating comma
+        record = json.loads(line.strip().rstrip(","))
+    except json.JSONDecodeError:
+        # Preambles, code fences and other chatter are not sections
+        return None
+    if not isinstance(record, dict) or not isinstance(record.get("title"), str):
+        return None
+    # Strip list markers and emphasis the model may still put inside the title
+    return OUTLINE_MARKER.sub("", record["title"]).strip(" *") or None
+
+async def _stream_outline(topic: str):
+    """Yields section titles one at a time as the planner streams its outline."""
+    prompt = f"""Create a detailed outline for a 50-page legal document on the topic: {topic}. Output ~50 section titles.
+
+Output ONLY JSON Lines: one object per line of the form {{"title": "<section title>"}}, with no numbering, code fences or other text."""
+    buffer = ""
+    async for chunk in pro_llm().astream(prompt):
+        buffer += extract_text(chunk)
+        # Every complete line is a finished record; the last piece may still be growing
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if title := _parse_title(line):
+                yield title
+    if title := _parse_title(buffer):
+        yield title
+
+async def plan_and_dispatch_node(state: DocumentState):
+    """Plans the outline and writes every section within a single graph step."""
+    topic = state["contract_topic"]
     file_path = state["file_path"]
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # Drop parts left behind by an interrupted run so they are not aggregated
+    for part in _section_parts(file_path):
+        os.remove(part)
+
+    # Dispatch each writer batch as soon as its titles have streamed in, so
+    # writing overlaps the rest of the planner call
+    context = _writer_context(topic)
+    sections: List[str] = []
+    batches = []
+    async with asyncio.TaskGroup() as tg:
+        async for title in _stream_outline(topic):
+            sections.append(title)
+            if len(sections) % WRITER_BATCH_SIZE == 0:
+                start = len(sections) - WRITER_BATCH_SIZE
+                batches.append(tg.create_task(_write_batch(file_path, context, sections[start:], start)))
+        if remainder := len(sections) % WRITER_BATCH_SIZE:
+            start = len(sections) - remainder
+            batches.append(tg.create_task(_write_batch(file_path, context, sections[start:], start)))
+    if not sections:
+        # Aggregating nothing would save a title-only document that every later run then skips
+        raise ValueError("The planner returned no parseable section titles.")
+
+    return {"sections_to_write": sections, "completed_sections": sum(b.result() for b in batches)}
+
+async def aggregator_node(state: DocumentState):
+    """Concatenates the section files in document order into the final markdown file."""
+    file_path = state["file_path"]
+    parts = _section_parts(file_path)
     
-    with open(file_path, "w") as f:
-        f.write(f"# {state['contract_topic']}\n\n")
-        for sec in sorted_sections:
-            f.write(f"## {sec['title']}\n\n")
-            # Ensure content is a clean string
-            content = sec['content']
-            f.write(f"{content}\n\n")
+    async with aiofiles.open(file_path, "w") as f:
+        await f.write(f"# {state['contract_topic']}\n\n")
+        for part in parts:
+            # One section at a time keeps memory bounded by the largest section, not the document
+            async with aiofiles.open(part, "r") as sec:
+                await f.write(await sec.read())
+            os.remove(part)
             
     return {} # State update handled via file system
 
+def _doc_digest(file_path: str) -> str:
+    """Content hash of the document; sidecar files are only trusted while it matches."""
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _sidecar_path(file_path: str, kind: str) -> str:
+    return f"{os.path.splitext(file_path)[0]}.{kind}.json"
+
+def _load_sidecar(file_path: str, kind: str, digest: str) -> Optional[dict]:
+    """Returns data saved next to the document, or None if missing or saved for another version of it."""
+    try:
+        with open(_sidecar_path(file_path, kind), "r") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    return data if data.get("digest") == digest else None
+
+def _save_sidecar(file_path: str, kind: str, digest: str, data: dict):
+    with open(_sidecar_path(file_path, kind), "w") as f:
+        json.dump({**data, "digest": digest}, f)
+
+def cache_doc_node(state: DocumentState):
+    """Uploads the document as Gemini cached content once and reuses it across runs until its TTL expires."""
+    file_path = state["file_path"]
+    digest = _doc_digest(file_path)
+    saved = _load_sidecar(file_path, "cache", digest)
+    if saved:
+        try:
+            # Still alive server-side: later questions only send the query
+            pro_llm().client.caches.get(name=saved["cache_name"])
+            return {"cache_name": saved["cache_name"]}
+        except APIError:
+            pass  # Expired or deleted; upload again below
+
+    with open(file_path, "r") as f:
+        doc_text = f.read()
+
+    try:
+        cache_name = create_context_cache(
+            pro_llm(),
+            [HumanMessage(content=f"Legal document under review:\n---\n{doc_text}\n---")],
+            ttl=DOC_CACHE_TTL
+        )
+    except APIError:
+        # e.g. document below the model's minimum cacheable size; qa_node falls back to retrieval
+        return {"cache_name": None}
+    _save_sidecar(file_path, "cache", digest, {"cache_name": cache_name})
+    return {"cache_name": cache_name}
+
+def _scan_sections(file_path: str) -> List[Tuple[str, int, int]]:
+    """(title, byte offset, byte length) of every '## ' section in the document."""
+    starts = []
+    offset = 0
+    with open(file_path, "rb") as f:
+        for line in f:
+            if line.startswith(b"## "):
+                starts.append((line[3:].decode().strip(), offset))
+            offset += len(line)
+    ends = [start for _, start in starts[1:]] + [offset]
+    return [(title, start, end - start) for (title, start), end in zip(starts, ends)]
+
+def _read_sections(file_path: str, entries: List[SectionIndexEntry]) -> List[str]:
+    """Reads just the given sections from the document by seeking to their offsets."""
+    texts = []
+    with open(file_path, "rb") as f:
+        for entry in entries:
+            f.seek(entry["offset"])
+            texts.append(f.read(entry["length"]).decode())
+    return texts
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a) * sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def index_doc_node(state: DocumentState):
+    """Embeds every section once per document version so QA turns without a cache only send the relevant ones."""
+    file_path = state["file_path"]
+    digest = _doc_digest(file_path)
+    if saved := _load_sidecar(file_path, "index", digest):
+        return {"section_index": saved["entries"]}
+
+    spans = _scan_sections(file_path)
+    entries = [{"title": title, "offset": offset, "length": length} for title, offset, length in spans]
+    embeddings = embedder().embed_documents(_read_sections(file_path, entries))
+    section_index = [{**entry, "embedding": emb} for entry, emb in zip(entries, embeddings)]
+    # Saved next to the document so later runs skip re-reading and re-embedding it
+    _save_sidecar(file_path, "index", digest, {"entries": section_index})
+    return {"section_index": section_index}
+
 def wait_for_query_node(state: DocumentState):
     """Pauses graph for user query."""
     query = interrupt("Document generation complete. Please enter your QA query.")
     return {"qa_query": query}
 
-def thinker_node(state: DocumentState):
-    """Generates a concise internal reasoning scratchpad."""
+async def _qa_document(state: DocumentState, query: str) -> str:
+    """Document context for the QA prompt when no server-side cache is used."""
+    section_index = state.get("section_index")
+    if section_index:
+        # Only the sections closest to the question go into the prompt, kept in document order
+        query_embedding = await embedder().aembed_query(query)
+        top = sorted(section_index, key=lambda e: _cosine(query_embedding, e["embedding"]), reverse=True)
+        excerpts = "".join(_read_sections(state["file_path"], sorted(top[:RETRIEVAL_TOP_K], key=lambda e: e["offset"])))
+        return f"""You are an expert legal analyst reviewing the most relevant sections of a legal document below.
+---
+{excerpts}
+---"""
     with open(state["file_path"], "r") as f:
         doc_text = f.read()
-    
-    query = state["qa_query"]
-    prompt = f"""You are an expert legal analyst reviewing the document below.
+    return f"""You are an expert legal analyst reviewing the document below.
 ---
 {doc_text}
----
+---"""
+
+def _qa_prompt(document: str, query: str) -> str:
+    return f"""{document}
 Question: {query}
 
 STRICT INSTRUCTIONS:
-1. Provide a internal reasoning scratchpad of ONLY 3-5 short bullet points.
+1. First, in `thought_process`, write an internal reasoning scratchpad of ONLY 3-5 short bullet points.
 2. Focus on: Where in the document is the answer? What clauses are relevant? What is the core logic for the answer?
-3. DO NOT provide the final answer yet.
-4. Keep it concise and analytical.
+3. Keep the scratchpad concise and analytical.
+4. Then, in `final_answer`, synthesize that reasoning into a professional and concise final answer to the question.
 """
 
-    response = pro_llm.invoke(prompt)
-    content = response.content
-    if isinstance(content, list):
-        content = "".join([block.get("text", "") if isinstance(block, dict) else str(block) for block in content])
-
-    return {"thought_process": content}
-
-def answer_node(state: DocumentState):
-    """Synthesizes the reasoning into a final answer."""
-    thought_process = state["thought_process"]
+async def qa_node(state: DocumentState):
+    """Produces the reasoning scratchpad and the final answer in a single structured call."""
     query = state["qa_query"]
-    
-    prompt = f"""Based on the following thought process, provide a professional and concise final answer to the user's query.
-    
-Thought Process:
-{thought_process}
+    cache_name = state.get("cache_name")
+    # Using structured output so one round-trip returns both fields
+    structured_llm = pro_llm().with_structured_output(QAResponse)
 
-User Question: {query}
-"""
-
-    response = flash_llm.invoke(prompt)
-    content = response.content
-    if isinstance(content, list):
-        content = "".join([block.get("text", "") if isinstance(block, dict) else str(block) for block in content])
+    response = None
+    if cache_name:
+        # The document is already held server-side; send only the question
+        document = "You are an expert legal analyst reviewing the legal document provided in context."
+        try:
+            response = await structured_llm.ainvoke(_qa_prompt(document, query), cached_content=cache_name)
+        except ChatGoogleGenerativeAIError:
+            # Cache expired or was evicted since it was checked; answer from the document on disk instead
+            pass
+    if response is None:
+        response = await structured_llm.ainvoke(_qa_prompt(await _qa_document(state, query), query))
 
-    return {"final_answer": content}
+    return {
+        "thought_process": response.thought_process,
+        "final_answer": response.final_answer
+    }
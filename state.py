@@ -2,11 +2,12 @@ from typing import TypedDict, List, Annotated, Optional
 import operator
 from pydantic import BaseModel, Field
 
-class SectionResult(TypedDict):
-    """The result from a single writer worker."""
+class SectionIndexEntry(TypedDict):
+    """Where one section sits in the document file, with its retrieval embedding."""
     title: str
-    content: str
-    index: int
+    offset: int
+    length: int
+    embedding: List[float]
 
 class DocumentState(TypedDict):
     # Core Context
@@ -16,19 +17,16 @@ class DocumentState(TypedDict):
     # Map-Reduce State (Agent 1)
     sections_to_write: List[str]  
     completed_sections: Annotated[int, operator.add] 
-    # Use operator.add on lists to accumulate worker results
-    generated_sections: Annotated[List[SectionResult], operator.add]
+    # Section text lives in per-section files on disk, not in state
     
     # QA & CoT State (Agent 2)
+    cache_name: Optional[str]  # Gemini cached-content handle for the document
+    section_index: Optional[List[SectionIndexEntry]]  # Retrieval index, built only without a cache
     qa_query: Optional[str]
     thought_process: Optional[str]
     final_answer: Optional[str]
 
-class WorkerState(TypedDict):
-    """State strictly for the isolated worker nodes executing via Send()"""
-    section_topic: str
-    index: int
-
-class SectionOutline(BaseModel):
-    """Structured output for the document outline."""
-    sections: List[str] = Field(description="List of detailed legal section titles.")
+class QAResponse(BaseModel):
+    """Structured output for a QA turn: reasoning scratchpad followed by the answer."""
+    thought_process: str = Field(description="Concise 3-5 bullet point reasoning scratchpad.")
+    final_answer: str = Field(description="Professional and concise final answer to the question.")
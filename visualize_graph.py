@@ -1,24 +1,38 @@
+import hashlib
 import os
+import shutil
 import sys
 
 # Ensure the current directory is in the path so graph.py can be imported
 sys.path.append(os.getcwd())
 
-from graph import graph
+from graph import gen_graph, qa_graph
 
-def generate_graph_png(output_filename="updated_workflow_graph.png"):
+CACHE_DIR = ".cache"
+
+def generate_graph_png(graph, output_filename="updated_workflow_graph.png"):
     print(f"Generating updated graph flow and saving to {output_filename}...")
     
     try:
         # Get the drawable representation of the compiled graph
         drawable_graph = graph.get_graph()
         
-        # Generate the PNG image bytes using Mermaid
-        png_bytes = drawable_graph.draw_mermaid_png()
+        # Key the cached PNG on the Mermaid source so unchanged graphs skip the
+        # round-trip to the Mermaid rendering service
+        mermaid_src = drawable_graph.draw_mermaid()
+        digest = hashlib.sha256(mermaid_src.encode()).hexdigest()
+        cache_path = os.path.join(CACHE_DIR, f"graph_{digest}.png")
+        
+        if os.path.exists(cache_path):
+            print("Graph unchanged; reusing cached PNG.")
+        else:
+            # Generate the PNG image bytes using Mermaid
+            png_bytes = drawable_graph.draw_mermaid_png()
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(cache_path, "wb") as f:
+                f.write(png_bytes)
         
-        # Write the bytes to a file
-        with open(output_filename, "wb") as f:
-            f.write(png_bytes)
+        shutil.copy(cache_path, output_filename)
             
         print(f"SUCCESS: Successfully saved the new graph to '{output_filename}'.")
         
@@ -28,4 +42,5 @@ def generate_graph_png(output_filename="updated_workflow_graph.png"):
         print(drawable_graph.draw_ascii())
 
 if __name__ == "__main__":
-    generate_graph_png()
\ No newline at end of file
+    generate_graph_png(gen_graph, "updated_workflow_graph.png")
+    generate_graph_png(qa_graph, "qa_workflow_graph.png")